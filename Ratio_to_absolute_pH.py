@@ -5,13 +5,15 @@
 #     Converts 465/405 ratiometric images to absolute apoplastic pH using
 #     user-defined normalization and polynomial conversion.
 #     Users must choose one calibration method: manual or from image means.
-#     Saves output as 32-bit TIFFs with LUT visualization.
+#     Saves output as 32-bit TIFFs (or calibrated 16-bit TIFFs) with LUT
+#     visualization.
 # -------------------------------------------------------------
 
 #@ String(value="<html style=\"width: 400px;text-align: center;\"><p style=\"margin:0px;padding:0px;font-size:12px;\"><b>Ratio to Absolute pH Conversion</b></p><p>This script converts ratiometric images (465/405) into absolute apoplastic pH values using a polynomial calibration. Choose either manual input or calibration images.</p></html>", visibility=MESSAGE, required=false) desc
 #@ File(label="Folder with your images (?)", style="directory", description="Input folder") input_dir
 #@ File(label="Folder to save your images (?)", style="directory", description="Output folder") output_dir
 #@ String(label="Extension for the images to look for (?)", value="tif", description="Extension of your images to select in the input folder") extension_ratio
+#@ Boolean(label="Reprocess images with an existing output (?)", value=false, description="By default, images whose output is newer than the image itself are skipped. Tick this after changing the calibration, coefficients, LUT, pH range or output bit depth") reprocess_existing
 #@ String(value="<html style=\"width: 233px;\"><div style=\"height: 1px; background: #c0c0c0;\"/></html>", visibility=MESSAGE, required=false) line1
 #@ String(label="Calibration mode", choices={"Manual", "From calibration images"}, value="Manual") calib_mode
 #@ Double(label="Lower calibration ratio (lower pH)", stepSize=0.000001, required=false) lower_ratio
@@ -27,19 +29,38 @@
 #@ String (label="LUT for visualization (?)", choices={"Green Fire Blue", "Fire", "Grays", "Ice", "Spectrum", "Red", "Green", "Blue", "Cyan", "Magenta", "Yellow", "Red/Green", "Cyan Hot", "HiLo", "ICA", "ICA2", "ICA3", "Magenta Hot", "Orange Hot", "Rainbow RGB", "Red Hot", "Thermal", "Yellow Hot", "blue orange icb", "cool", "gem", "glow", "mpl-inferno", "mpl-magma", "mpl-plasma", "mpl-viridis", "phase", "physics", "royal", "sepia", "smart", "thal", "thallium", "unionjack"}, description="Select the lookup table for final coloring") lut_method
 #@ Double(label="pH range minimum", value=5.0, stepSize=0.01) pH_min
 #@ Double(label="pH range maximum", value=7.0, stepSize=0.01) pH_max
+#@ String(label="Output bit depth (?)", choices={"32-bit", "16-bit"}, value="32-bit", description="16-bit stores the pH range minimum to maximum as 1-65535 (0 = background) with a pH calibration; values outside the range are clamped") output_bit_depth
 #@ String(value="<html style=\"width: 400px;text-align: center;\">Please cite Barbez et al. 2017<br/>and Rößling et al. 2025</html>", visibility=MESSAGE, required=false) footer
 
 # ─── IMPORTS ────────────────────────────────────────────────────────────────────
 
 import os
-import math
 import time
-import fnmatch
+import jarray
+
+from collections import deque
 
 from ij import IJ, ImagePlus
-from ij.process import FloatProcessor
+from ij.measure import Calibration, Measurements
+from ij.gui import ImageRoi, Overlay
+from ij.io import FileInfo, Opener
+from ij.process import ColorProcessor, FloatProcessor, ImageProcessor, ImageStatistics, ShortProcessor
 from ij.plugin import LutLoader
 
+from java.awt import Color, Font
+from java.io import ByteArrayOutputStream, IOException, StringWriter
+from java.lang import ClassLoader, ClassNotFoundException, Integer, Runtime, Throwable
+from java.net import URI
+from java.nio import ByteBuffer, ByteOrder
+from java.nio.channels import FileChannel
+from java.nio.file import Files, FileVisitResult, Paths, SimpleFileVisitor, StandardCopyOption, StandardOpenOption
+from java.util.concurrent import ArrayBlockingQueue, Callable, CountDownLatch, Executors, Semaphore, ThreadPoolExecutor, TimeUnit
+from java.util.concurrent.atomic import AtomicInteger
+from javax.tools import ForwardingJavaFileManager, JavaFileObject, SimpleJavaFileObject, ToolProvider
+
+from loci.formats import FormatException, FormatTools, ImageReader, MetadataTools
+from loci.formats.out import TiffWriter
+
 # ─── FUNCTIONS ──────────────────────────────────────────────────────────────────
 
 def progress_bar(progress, total, line_number, prefix=""):
@@ -77,6 +98,59 @@ def timed_log(message):
     IJ.log(time.strftime("%H:%M:%S", time.localtime()) + ": " + message)
 
 
+class Task(Callable):
+    """Wraps a function call so it can be submitted to an ExecutorService
+
+    Parameters
+    ----------
+    function : callable
+        Function to run on the worker thread
+    *args
+        Arguments passed to the function
+    """
+
+    def __init__(self, function, *args):
+        self.function = function
+        self.args = args
+
+    def call(self):
+        return self.function(*self.args)
+
+
+class FileCollector(SimpleFileVisitor):
+    """Collects the regular files with one of the extensions while walking a folder tree
+
+    Folders and files that can't be read are skipped instead of ending the walk.
+
+    Parameters
+    ----------
+    filteringStrings : (str)
+        Lower case extensions to look for
+    """
+
+    def __init__(self, filteringStrings):
+        SimpleFileVisitor.__init__(self)
+        self.filteringStrings = filteringStrings
+        self.files = []
+
+    def visitFile(self, path, attrs):
+        # Check if the file matches any of the extensions (case-insensitive)
+        # Without FOLLOW_LINKS, symbolic links come with their own attributes
+        if (attrs.isRegularFile() or attrs.isSymbolicLink() and Files.isRegularFile(path)) \
+                and path.toString().lower().endswith(self.filteringStrings):
+            self.files.append(path.toString())
+        return FileVisitResult.CONTINUE
+
+    def visitFileFailed(self, path, exc):
+        timed_log("Info: Could not read, skipping: {}".format(path))
+        return FileVisitResult.CONTINUE
+
+    def postVisitDirectory(self, path, exc):
+        if exc is not None:
+            timed_log("Info: Could not read the whole folder: {}".format(path))
+        return FileVisitResult.CONTINUE
+
+
 def getFileList(directory, extensions):
     """Get a list of files with the extension
 
@@ -93,70 +167,308 @@ def getFileList(directory, extensions):
         List of files with the extension in the folder
     """
     
-    files = []
-    filteringStrings = [ext.lower() for ext in extensions]
-    for dirpath, dirnames, filenames in os.walk(directory):
-        for filename in filenames:
-            # Check if the file matches any of the extensions (case-insensitive)
-            if any(fnmatch.fnmatch(filename.lower(), "*" + ext) for ext in extensions):
-                files.append(os.path.join(dirpath, filename))
-    return files
+    collector = FileCollector(tuple(ext.lower() for ext in extensions))
+    Files.walkFileTree(Paths.get(directory), collector)
+    return collector.files
 
 
-def normalize_pixel(val, lower, upper):
-    """Normalizes a pixel value within a given range
+def get_output_path(file, output_dir):
+    """Get the path the converted image of a file is saved to
 
     Parameters
     ----------
-    val : float
-        The pixel value to be normalized
-    lower : float
-        The minimum value of the normalization range
-    upper : float
-        The maximum value of the normalization range
-        
+    file : str
+        Path of the ratio image
+    output_dir : str
+        Folder the converted images are saved to
+
+    Returns
+    -------
+    str
+        Path of the pH image, with the .tif extension IJ.saveAsTiff would use
+    """
+
+    name, ext = os.path.splitext(os.path.basename(file))
+    if ext != ".tiff":
+        ext = ".tif"
+    return os.path.join(output_dir, "pH_" + name + ext)
+
+
+def get_temp_path(out_path):
+    """Get the path a converted image is written to before it is renamed to out_path
+
+    Parameters
+    ----------
+    out_path : str
+        Path of the converted image
+
     Returns
     -------
-    float
-        The normalized value 
+    str
+        Path in the same folder, with the same extension so IJ.saveAsTiff keeps it
+    """
+
+    return os.path.join(os.path.dirname(out_path), ".part_" + os.path.basename(out_path))
+
+
+def move_to_output(temp_path, out_path):
+    """Renames a completely written image to its output path, replacing an older output
+
+    Parameters
+    ----------
+    temp_path : str
+        Path the image was written to
+    out_path : str
+        Path of the converted image
+    """
+
+    Files.move(Paths.get(temp_path), Paths.get(out_path), StandardCopyOption.REPLACE_EXISTING)
+
+
+def is_up_to_date(file, out_path):
+    """Check if the converted image exists and is newer than the ratio image
+
+    Parameters
+    ----------
+    file : str
+        Path of the ratio image
+    out_path : str
+        Path of the converted image
+
+    Returns
+    -------
+    bool
+        True if the ratio image does not need to be converted again
+    """
+
+    return os.path.exists(out_path) and os.path.getmtime(out_path) > os.path.getmtime(file)
+
+
+PH_KERNEL_SOURCE = """
+public class PhKernel {
+    private static final int TABLE_SIZE = 65536;
+    private final float[] table = new float[TABLE_SIZE];
+
+    public PhKernel(double b3, double b2, double b1, double b0) {
+        for (int k = 0; k < TABLE_SIZE; k++) {
+            double n = k / (double) (TABLE_SIZE - 1);
+            table[k] = (float) (((b3 * n + b2) * n + b1) * n + b0);
+        }
+    }
+
+    public void apply(float[] src, float[] dst, double lo, double invRange) {
+        double scale = invRange * (TABLE_SIZE - 1);
+        for (int i = 0; i < src.length; i++) {
+            float v = src[i];
+            if (Float.isNaN(v) || v == 0f) {
+                dst[i] = Float.NaN;
+                continue;
+            }
+            double k = (v - lo) * scale;
+            int index;
+            if (k <= 0) index = 0;
+            else if (k >= TABLE_SIZE - 1) index = TABLE_SIZE - 1;
+            else index = (int) (k + 0.5);
+            dst[i] = table[index];
+        }
+    }
+
+    public void quantize(float[] src, short[] dst, double lo, double scale) {
+        for (int i = 0; i < src.length; i++) {
+            float v = src[i];
+            if (Float.isNaN(v)) {
+                dst[i] = 0;
+                continue;
+            }
+            long q = 1 + Math.round((v - lo) * scale);
+            if (q < 1) q = 1;
+            else if (q > 65535) q = 65535;
+            dst[i] = (short) q;
+        }
+    }
+}
+"""
+
+
+class SourceObject(SimpleJavaFileObject):
+    """Java source file held in a string, for compiling without touching the disk
+
+    Parameters
+    ----------
+    name : str
+        Name of the class defined in the source
+    source : str
+        The Java source code
+    """
+
+    def __init__(self, name, source):
+        SimpleJavaFileObject.__init__(self, URI.create("string:///" + name + ".java"),
+                                      JavaFileObject.Kind.SOURCE)
+        self.source = source
+
+    def getCharContent(self, ignoreEncodingErrors):
+        return self.source
+
+
+class ClassObject(SimpleJavaFileObject):
+    """Compiled class file held in memory
+
+    Parameters
+    ----------
+    name : str
+        Binary name of the compiled class
+    """
+
+    def __init__(self, name):
+        SimpleJavaFileObject.__init__(self, URI.create("bytes:///" + name.replace(".", "/") + ".class"),
+                                      JavaFileObject.Kind.CLASS)
+        self.bytes = ByteArrayOutputStream()
+
+    def openOutputStream(self):
+        return self.bytes
+
+
+class MemoryFileManager(ForwardingJavaFileManager):
+    """File manager that keeps the class files written by the compiler in memory
+
+    Parameters
+    ----------
+    file_manager : JavaFileManager
+        The standard file manager of the compiler, used to look up the JDK classes
     """
 
-    norm = (val - lower) / (upper - lower)
-    return max(0.0, min(1.0, norm))  # Clamp to [0, 1]
+    def __init__(self, file_manager):
+        ForwardingJavaFileManager.__init__(self, file_manager)
+        self.classes = {}
+
+    def getJavaFileForOutput(self, location, className, kind, sibling):
+        self.classes[className] = ClassObject(className)
+        return self.classes[className]
 
 
-def convert_to_pH(norm_val, B3, B2, B1, B0):
-	"""Converts a normalized value to a pH value using a polynomial
+class MemoryClassLoader(ClassLoader):
+    """Class loader that defines classes from the class files of a MemoryFileManager
+
+    Parameters
+    ----------
+    classes : dict
+        Compiled classes by binary name, as collected by MemoryFileManager
+    """
+
+    def __init__(self, classes):
+        ClassLoader.__init__(self, ClassLoader.getSystemClassLoader())
+        self.classes = classes
+
+    def findClass(self, name):
+        if name not in self.classes:
+            raise ClassNotFoundException(name)
+        data = self.classes[name].bytes.toByteArray()
+        return self.defineClass(name, data, 0, len(data))
+
+
+def load_pH_kernel(B3, B2, B1, B0):
+    """Compiles the per-pixel pH conversion to a Java class and creates a kernel
+
+    The class is compiled in memory on every run, so no class file is ever read
+    back from disk. Compiling needs a JDK; Fiji running on a plain JRE has no
+    system Java compiler. Whenever compiling or loading the class fails, the
+    conversion falls back to the ImageJ macro kernel.
+
+    The kernel tabulates the polynomial at 65536 evenly spaced normalized
+    values, so converting a pixel is a table lookup instead of evaluating the
+    polynomial. The lookup is off by at most half a table step, i.e. about
+    3e-5 pH for the default coefficients.
 
     Parameters
     ----------
-    norm_val : float
-        The normalized value (between 0.0 and 1.0) that will be transformed into a pH value
     B3 : float
-        The coefficient for the cubic term (x³) 
+        The coefficient for the term (x³) used in the conversion to pH
     B2 : float
-        The coefficient for the quadratic term (x²) 
+        The coefficient for the term (x²) used in the conversion to pH
     B1 : float
-        The coefficient for the linear term (x¹) 
+        The coefficient for the term (x¹) used in the conversion to pH
     B0 : float
-        The constant term (the offset) 
-        
+        The constant term (offset) used in the conversion to pH.
+
     Returns
     -------
-    float
-        The calculated pH value based on the polynomial: B3 * x³ + B2 * x² + B1 * x + B0.
+    PhKernel
+        The kernel for these coefficients, or None if it could not be compiled
     """
-    
-	return B3 * norm_val**3 + B2 * norm_val**2 + B1 * norm_val + B0
 
+    compiler = ToolProvider.getSystemJavaCompiler()
+    if compiler is None:
+        timed_log("Info: No Java compiler available, using the ImageJ macro kernel")
+        return None
+
+    try:
+        file_manager = MemoryFileManager(compiler.getStandardFileManager(None, None, None))
+        messages = StringWriter()
+        task = compiler.getTask(messages, file_manager, None, None, None,
+                                [SourceObject("PhKernel", PH_KERNEL_SOURCE)])
+        if not task.call():
+            timed_log("Info: Could not compile the pH kernel, using the ImageJ macro kernel")
+            return None
+        loader = MemoryClassLoader(file_manager.classes)
+        return loader.loadClass("PhKernel")(B3, B2, B1, B0)
+    except (Exception, Throwable) as error:
+        timed_log("Info: Could not load the pH kernel ({}), using the ImageJ macro kernel".format(error))
+        return None
+
+
+def convert_pixels(ip, lower, upper, B3, B2, B1, B0, kernel=None):
+    """Converts the ratio values of a 32-bit processor to pH values in place
 
-def process_image(img, lower, upper, B3, B2, B1, B0):
+    Zero (background) and NaN pixels become NaN. All other pixels are
+    normalized to [lower, upper], clamped to [0, 1] and passed through the
+    polynomial B3 * x³ + B2 * x² + B1 * x + B0.
+
+    Parameters
+    ----------
+    ip : FloatProcessor
+        The processor whose pixel values are converted
+    lower : float
+        The lower bound for the normalization of pixel values
+    upper : float
+        The upper bound for the normalization of pixel values
+    B3 : float
+        The coefficient for the term (x³) used in the conversion to pH
+    B2 : float
+        The coefficient for the term (x²) used in the conversion to pH
+    B1 : float
+        The coefficient for the term (x¹) used in the conversion to pH
+    B0 : float
+        The constant term (offset) used in the conversion to pH.
+    kernel : PhKernel, optional
+        The compiled pixel kernel from load_pH_kernel. If None, the conversion
+        falls back to an ImageJ macro expression, by default None
+    """
+
+    inv_range = 1.0 / (upper - lower)
+    if kernel is not None:
+        pixels = ip.getPixels()
+        kernel.apply(pixels, pixels, lower, inv_range)
+    else:
+        # Same computation as the compiled kernel, but evaluating the polynomial
+        # directly, in a single pass of ImageJ's own pixel loop. The
+        # ImageProcessor method is used rather than IJ.run(), whose Process>Math
+        # commands keep their settings in static fields and can't run in
+        # parallel. minOf/maxOf are java.lang.Math.min/max, which pass NaN
+        # through, so only the zero background needs an explicit test.
+        ip.applyMacro(
+            "if (v==0) v=NaN;"
+            " v=minOf(maxOf((v-{!r})*{!r}, 0), 1);"
+            " v=(({!r}*v+{!r})*v+{!r})*v+{!r};".format(lower, inv_range, B3, B2, B1, B0)
+        )
+
+
+def process_image(img, lower, upper, B3, B2, B1, B0, kernel=None):
 	"""Processes an image to convert pixel values into pH values by normalizing and applying a polynomial.
 	
 	Parameters
 	----------
 	img : ImagePlus
-	    The input image whose pixel values will be processed and converted into pH values
+	    The 32-bit input image whose pixel values will be processed and converted into pH values
 	lower : float
 	    The lower bound for the normalization of pixel values
 	upper : float
@@ -169,30 +481,572 @@ def process_image(img, lower, upper, B3, B2, B1, B0):
 	    The coefficient for the term (x¹) used in the conversion to pH
 	B0 : float
 	    The constant term (offset) used in the conversion to pH.
+	kernel : PhKernel, optional
+	    The compiled pixel kernel from load_pH_kernel. If None, the conversion
+	    falls back to an ImageJ macro expression, by default None
 	
 	Returns
 	-------
 	ImagePlus
-	    A new imageplus where pixel values are converted into pH values
+	    A new imageplus where pixel values are converted into pH values. It shares
+	    its pixel data with img, which is converted in place
 	"""
     
-   	ip = img.getProcessor().duplicate().convertToFloat()
-	width = ip.getWidth()
-   	height = ip.getHeight()
-   	pH_ip = FloatProcessor(width, height)
-   	
-   	for y in range(height):
-   		for x in range(width):
-   			val = ip.getf(x, y)
-   			
-   			if math.isnan(val) or val == 0.0:
-   				pH_ip.setf(x, y, float('nan'))
-   			else:
-   				norm_val = normalize_pixel(val, lower, upper)
-   				pH_val = convert_to_pH(norm_val, B3, B2, B1, B0)
-   				pH_ip.setf(x, y, pH_val)
-
-   	return ImagePlus("pH_" + img.getTitle(), pH_ip)
+	# The input is already 32-bit and is only opened for this conversion, so
+	# its pixels are converted in place instead of working on a copy
+	pH_ip = img.getProcessor()
+
+	convert_pixels(pH_ip, lower, upper, B3, B2, B1, B0, kernel)
+
+	return ImagePlus("pH_" + img.getTitle(), pH_ip)
+
+
+def quantize_image(img, min_value, max_value, kernel=None):
+    """Converts a 32-bit pH image to a calibrated 16-bit image
+
+    Values from min_value to max_value are mapped linearly onto 1-65535 and
+    clamped outside that range; NaN (background) becomes 0. A straight-line
+    calibration function maps the pixel values back to pH.
+
+    Parameters
+    ----------
+    img : ImagePlus
+        The 32-bit pH image
+    min_value : float
+        The pH value stored as 1
+    max_value : float
+        The pH value stored as 65535
+    kernel : PhKernel, optional
+        The compiled pixel kernel from load_pH_kernel. If None, the conversion
+        falls back to an ImageJ macro expression, by default None
+
+    Returns
+    -------
+    ImagePlus
+        A new 16-bit imageplus with the same title, calibrated in pH
+    """
+
+    ip = img.getProcessor()
+    step = (max_value - min_value) / 65534.0
+    if kernel is not None:
+        # The kernel fills every element, so the processor wraps this array
+        # instead of allocating (and zeroing) one of its own
+        pixels = jarray.zeros(ip.getPixelCount(), 'h')
+        kernel.quantize(ip.getPixels(), pixels, min_value, 1.0 / step)
+        short_ip = ShortProcessor(ip.getWidth(), ip.getHeight(), pixels, None)
+    else:
+        # Round to the final integer values in place, so the unscaled
+        # conversion to 16-bit keeps them exactly
+        ip.applyMacro(
+            "if (isNaN(v)) v=0;"
+            " else v=minOf(maxOf(1+round((v-{!r})*{!r}), 1), 65535);".format(min_value, 1.0 / step)
+        )
+        short_ip = ip.convertToShort(False)
+
+    quantized_img = ImagePlus(img.getTitle(), short_ip)
+    quantized_img.getCalibration().setFunction(Calibration.STRAIGHT_LINE,
+                                               jarray.array([min_value - step, step], 'd'), "pH")
+    return quantized_img
+
+
+def make_calibration_bar(lut, min_value, max_value, n_labels=5, decimals=3, font_size=12):
+    """Draws a vertical calibration bar for a LUT, like Analyze>Tools>Calibration Bar
+
+    Parameters
+    ----------
+    lut : LUT
+        The lookup table to show in the bar
+    min_value : float
+        The value at the bottom of the bar
+    max_value : float
+        The value at the top of the bar
+    n_labels : int, optional
+        Number of labelled ticks along the bar, by default 5
+    decimals : int, optional
+        Number of decimal places of the labels, by default 3
+    font_size : int, optional
+        Font size of the labels, by default 12
+
+    Returns
+    -------
+    ColorProcessor
+        The calibration bar with black labels on a white background
+    """
+
+    bar_length = 128
+    bar_width = 12
+    tick_length = 4
+    margin = 10
+
+    labels = [IJ.d2s(min_value + (max_value - min_value) * k / (n_labels - 1.0), decimals)
+              for k in range(n_labels)]
+    font = Font("SansSerif", Font.PLAIN, font_size)
+    measure_ip = ColorProcessor(1, 1)
+    measure_ip.setFont(font)
+    text_width = max(measure_ip.getStringWidth(label) for label in labels)
+
+    bar_ip = ColorProcessor(2 * margin + bar_width + 2 * tick_length + text_width,
+                            2 * margin + bar_length)
+    bar_ip.setColor(Color.WHITE)
+    bar_ip.fill()
+
+    # Color ramp, maximum at the top
+    for y in range(bar_length):
+        index = int(round(255.0 * (bar_length - 1 - y) / (bar_length - 1)))
+        bar_ip.setColor(Color(lut.getRGB(index)))
+        bar_ip.drawLine(margin, margin + y, margin + bar_width - 1, margin + y)
+
+    bar_ip.setColor(Color.BLACK)
+    bar_ip.drawRect(margin - 1, margin - 1, bar_width + 2, bar_length + 2)
+
+    # Ticks and labels
+    bar_ip.setFont(font)
+    bar_ip.setAntialiasedText(True)
+    for k, label in enumerate(labels):
+        y = margin + bar_length - 1 - int(round((bar_length - 1) * k / (n_labels - 1.0)))
+        bar_ip.drawLine(margin + bar_width, y, margin + bar_width + tick_length, y)
+        bar_ip.drawString(label, margin + bar_width + 2 * tick_length, y + font_size / 2)
+
+    return bar_ip
+
+
+def open_image(file, info=None, chunk_size=8 * 1024 * 1024):
+    """Opens an image, reading plain 32-bit TIFFs straight into the pixel array
+
+    A single uncompressed 32-bit float image stored in one contiguous block is
+    read in chunks through a small heap buffer and copied directly into the
+    pixel array of a new FloatProcessor, bypassing ImageJ's TIFF decoder. The
+    file is closed as soon as the pixels are read. Everything else is opened
+    with IJ.openImage.
+
+    Parameters
+    ----------
+    file : str
+        Path of the image to open
+    info : [FileInfo], optional
+        The TIFF file info from Opener.getTiffFileInfo, by default None
+    chunk_size : int, optional
+        Number of bytes read from the file at once, a multiple of 4, by
+        default 8 MB
+
+    Returns
+    -------
+    ImagePlus
+        The opened image, or None if it could not be opened
+    """
+
+    if info is None or len(info) != 1:
+        return IJ.openImage(file)
+    fi = info[0]
+    if fi.fileType != FileInfo.GRAY32_FLOAT or fi.compression > FileInfo.COMPRESSION_NONE or fi.nImages > 1:
+        return IJ.openImage(file)
+
+    # The pixels must fit in one buffer and the strips must follow each other
+    # without gaps
+    size = 4 * fi.width * fi.height
+    if size > Integer.MAX_VALUE:
+        return IJ.openImage(file)
+    if fi.stripOffsets is not None and fi.stripLengths is not None and len(fi.stripOffsets) > 1:
+        end = fi.stripOffsets[0]
+        for offset, length in zip(fi.stripOffsets, fi.stripLengths):
+            if offset != end:
+                return IJ.openImage(file)
+            end += length
+
+    pixels = jarray.zeros(fi.width * fi.height, 'f')
+    buffer = ByteBuffer.allocate(min(size, chunk_size))
+    buffer.order(ByteOrder.LITTLE_ENDIAN if fi.intelByteOrder else ByteOrder.BIG_ENDIAN)
+    try:
+        channel = FileChannel.open(Paths.get(file), StandardOpenOption.READ)
+        try:
+            if fi.getOffset() + size > channel.size():
+                return IJ.openImage(file)
+            read = 0
+            while read < size:
+                buffer.clear()
+                buffer.limit(min(size - read, buffer.capacity()))
+                while buffer.hasRemaining():
+                    if channel.read(buffer, fi.getOffset() + read + buffer.position()) < 0:
+                        return IJ.openImage(file)
+                buffer.flip()
+                buffer.asFloatBuffer().get(pixels, read / 4, buffer.limit() / 4)
+                read += buffer.limit()
+        finally:
+            channel.close()
+    except IOException:
+        # Let ImageJ try, it returns None if the file can't be read at all
+        return IJ.openImage(file)
+
+    return ImagePlus(os.path.basename(file), FloatProcessor(fi.width, fi.height, pixels, None))
+
+
+def get_memory_cost(width, height, bytes_per_pixel):
+    """Gets the memory an image holds while it is converted, in whole megabytes
+
+    Parameters
+    ----------
+    width : int
+        Width of the image in pixels
+    height : int
+        Height of the image in pixels
+    bytes_per_pixel : int
+        Bytes held per pixel until the converted image is written
+
+    Returns
+    -------
+    int
+        The memory in megabytes, rounded up and at least 1
+    """
+
+    megabyte = 1024 * 1024
+    return max(1, int((bytes_per_pixel * width * height + megabyte - 1) / megabyte))
+
+
+class ConversionSettings(object):
+    """The parameters of the conversion, shared by all files
+
+    Parameters
+    ----------
+    lower : float
+        The lower bound for the normalization of pixel values
+    upper : float
+        The upper bound for the normalization of pixel values
+    B3 : float
+        The coefficient for the term (x³) used in the conversion to pH
+    B2 : float
+        The coefficient for the term (x²) used in the conversion to pH
+    B1 : float
+        The coefficient for the term (x¹) used in the conversion to pH
+    B0 : float
+        The constant term (offset) used in the conversion to pH.
+    kernel : PhKernel
+        The compiled pixel kernel from load_pH_kernel, or None for the ImageJ
+        macro kernel
+    pH_min : float
+        The pH at the bottom of the LUT
+    pH_max : float
+        The pH at the top of the LUT
+    output_bit_depth : str
+        "32-bit" or "16-bit"
+    lut : LUT
+        The lookup table of the converted images
+    calibration_bar : ColorProcessor
+        The calibration bar drawn onto the converted images
+    output_dir : str
+        Folder the converted images are saved to
+    """
+
+    def __init__(self, lower, upper, B3, B2, B1, B0, kernel, pH_min, pH_max,
+                 output_bit_depth, lut, calibration_bar, output_dir):
+        self.lower = lower
+        self.upper = upper
+        self.B3 = B3
+        self.B2 = B2
+        self.B1 = B1
+        self.B0 = B0
+        self.kernel = kernel
+        self.pH_min = pH_min
+        self.pH_max = pH_max
+        self.output_bit_depth = output_bit_depth
+        self.lut = lut
+        self.calibration_bar = calibration_bar
+        self.output_dir = output_dir
+
+
+def save_file(pH_img, out_path, cost, memory_permits, files_done):
+    """Saves a converted image as TIFF, frees the memory it holds and counts it as done
+
+    The image is written under a temporary name and only renamed to out_path
+    once it is saved completely, so a failed or interrupted write never leaves
+    an output that a later run would take as up to date.
+
+    Parameters
+    ----------
+    pH_img : ImagePlus
+        The converted image to save
+    out_path : str
+        Path of the TIFF file to write
+    cost : int
+        The memory permits held by the image
+    memory_permits : Semaphore
+        The memory permits of the images in flight, in megabytes
+    files_done : AtomicInteger
+        Number of files done, for the progress bar
+    """
+
+    temp_path = get_temp_path(out_path)
+    try:
+        if IJ.saveAsTiff(pH_img, temp_path):
+            move_to_output(temp_path, out_path)
+        else:
+            timed_log("Info: Could not save image: {}".format(os.path.basename(out_path)))
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        memory_permits.release(cost)
+        files_done.incrementAndGet()
+
+
+def convert_file(file, img, cost, settings, write_pool, memory_permits, files_done):
+    """Converts an opened ratio image to pH and saves it to the output folder
+
+    Runs on a worker thread: it only touches its own images and never goes
+    through the WindowManager.
+
+    Parameters
+    ----------
+    file : str
+        Path of the ratio image to convert
+    img : ImagePlus
+        The opened ratio image, or None if it could not be opened
+    cost : int
+        The memory permits held by the image, released once it is written
+    settings : ConversionSettings
+        The parameters of the conversion
+    write_pool : ExecutorService
+        The single thread that writes the converted images
+    memory_permits : Semaphore
+        The memory permits of the images in flight, in megabytes
+    files_done : AtomicInteger
+        Number of files done, for the progress bar
+
+    Returns
+    -------
+    Future
+        The pending write of the converted image, or None if it was skipped
+    """
+
+    # Get basename of file
+    basename = os.path.basename(file)
+
+    if img is None:
+        timed_log("Info: Could not open image: {}".format(basename))
+        memory_permits.release(cost)
+        files_done.incrementAndGet()
+        return
+
+    if img.getProcessor().getBitDepth() != 32:
+        timed_log("Info: Image is not 32-bit: {}".format(basename))
+        memory_permits.release(cost)
+        files_done.incrementAndGet()
+        return
+
+    try:
+        pH_img = convert_image(img, settings)
+    except:
+        memory_permits.release(cost)
+        raise
+
+    # Save image
+    out_path = get_output_path(file, settings.output_dir)
+    return write_pool.submit(Task(save_file, pH_img, out_path, cost, memory_permits, files_done))
+
+
+def convert_image(img, settings):
+    """Converts an opened 32-bit ratio image to a pH image with LUT and calibration bar
+
+    Parameters
+    ----------
+    img : ImagePlus
+        The 32-bit ratio image, converted in place
+    settings : ConversionSettings
+        The parameters of the conversion
+
+    Returns
+    -------
+    ImagePlus
+        The pH image, ready to be saved
+    """
+
+    # Process the image 
+    pH_img = process_image(img, settings.lower, settings.upper, settings.B3, settings.B2,
+                           settings.B1, settings.B0, settings.kernel)
+    if settings.output_bit_depth == "16-bit":
+        pH_img = quantize_image(pH_img, settings.pH_min, settings.pH_max, settings.kernel)
+
+    # Apply LUT
+    pH_img.getProcessor().setLut(settings.lut)
+
+    # Set Calibration Bar
+    cal = pH_img.getCalibration()
+    pH_img.getProcessor().setMinAndMax(cal.getRawValue(settings.pH_min), cal.getRawValue(settings.pH_max))
+    bar_x = max(0, pH_img.getWidth() - settings.calibration_bar.getWidth())
+    pH_img.setOverlay(Overlay(ImageRoi(bar_x, 0, settings.calibration_bar)))
+    return pH_img
+
+
+def stream_file(file, settings, files_done, strip_height=512):
+    """Converts a ratio image that is too large to hold in memory, strip by strip
+
+    The image is read and written with Bio-Formats, strip_height rows at a
+    time, so only one strip of pixels is in memory at once. The output is a
+    plain 32-bit TIFF, whatever the output bit depth: Bio-Formats can't store
+    the ImageJ LUT, the calibration bar overlay or a pH calibration function.
+
+    Parameters
+    ----------
+    file : str
+        Path of the ratio image to convert
+    settings : ConversionSettings
+        The parameters of the conversion
+    files_done : AtomicInteger
+        Number of files done, for the progress bar
+    strip_height : int, optional
+        Number of image rows converted at once, by default 512
+    """
+
+    # Get basename of file
+    basename = os.path.basename(file)
+
+    reader = ImageReader()
+    try:
+        reader.setId(file)
+        if reader.getPixelType() != FormatTools.FLOAT or reader.getRGBChannelCount() != 1:
+            timed_log("Info: Image is not 32-bit: {}".format(basename))
+            return
+        if reader.getSeriesCount() != 1 or reader.getImageCount() != 1:
+            timed_log("Info: Image has more than one plane, skipping: {}".format(basename))
+            return
+
+        width = reader.getSizeX()
+        height = reader.getSizeY()
+        order = ByteOrder.LITTLE_ENDIAN if reader.isLittleEndian() else ByteOrder.BIG_ENDIAN
+        if settings.output_bit_depth == "16-bit":
+            timed_log("Info: Image too large for memory, saving as 32-bit without LUT and calibration bar: {}".format(basename))
+        else:
+            timed_log("Info: Image too large for memory, saving without LUT and calibration bar: {}".format(basename))
+
+        # Write under a temporary name, renamed once the image is complete
+        out_path = get_output_path(file, settings.output_dir)
+        temp_path = get_temp_path(out_path)
+        if os.path.exists(temp_path):
+            # TiffWriter would append to the existing file
+            os.remove(temp_path)
+        meta = MetadataTools.createOMEXMLMetadata()
+        MetadataTools.populateMetadata(meta, 0, "pH_" + basename, True, "XYZCT",
+                                       FormatTools.getPixelTypeString(FormatTools.FLOAT),
+                                       width, height, 1, 1, 1, 1)
+        writer = TiffWriter()
+        writer.setMetadataRetrieve(meta)
+        writer.setBigTiff(width * height * 4 > 2 ** 31)
+        writer.setId(temp_path)
+        try:
+            try:
+                raw = strip = None
+                for y in range(0, height, strip_height):
+                    rows = min(strip_height, height - y)
+                    if strip is None or len(strip) != width * rows:
+                        raw = jarray.zeros(width * rows * 4, 'b')
+                        strip = jarray.zeros(width * rows, 'f')
+
+                    reader.openBytes(0, raw, 0, y, width, rows)
+                    ByteBuffer.wrap(raw).order(order).asFloatBuffer().get(strip)
+                    convert_pixels(FloatProcessor(width, rows, strip, None), settings.lower, settings.upper,
+                                   settings.B3, settings.B2, settings.B1, settings.B0, settings.kernel)
+                    ByteBuffer.wrap(raw).order(ByteOrder.LITTLE_ENDIAN).asFloatBuffer().put(strip)
+                    writer.saveBytes(0, raw, 0, y, width, rows)
+            finally:
+                writer.close()
+            move_to_output(temp_path, out_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+    except (FormatException, IOException) as error:
+        timed_log("Info: Could not open image: {} ({})".format(basename, error))
+    finally:
+        reader.close()
+        files_done.incrementAndGet()
+
+
+def prepare_file(file, turn, next_turn, settings, write_pool, memory_permits, memory_budget, files_done):
+    """Reads the header of a ratio image and opens it, unless it has to be streamed
+
+    Runs in the reader pool, so the TIFF header is parsed off the main thread.
+    Waits until enough memory permits are free before the image is opened.
+    The permits are taken in file order: otherwise a later image could hold
+    the memory an earlier one waits for, while the main thread waits for the
+    earlier one.
+
+    Parameters
+    ----------
+    file : str
+        Path of the ratio image to open
+    turn : CountDownLatch
+        Opened once the previous file has taken its memory permits
+    next_turn : CountDownLatch
+        Opened once this file has taken its memory permits
+    settings : ConversionSettings
+        The parameters of the conversion
+    write_pool : ExecutorService
+        The single thread that writes the converted images
+    memory_permits : Semaphore
+        The memory permits of the images in flight, in megabytes
+    memory_budget : int
+        Total number of memory permits
+    files_done : AtomicInteger
+        Number of files done, for the progress bar
+
+    Returns
+    -------
+    Task
+        The conversion to run for the file: convert_file with the opened image,
+        or stream_file if the image is too large to be held in memory
+    """
+
+    # The 16-bit output holds the 32-bit and the 16-bit pixels at the same time
+    bytes_per_pixel = 6 if settings.output_bit_depth == "16-bit" else 4
+
+    info = img = None
+    try:
+        if file.lower().endswith((".tif", ".tiff")):
+            info = Opener.getTiffFileInfo(file)
+
+        if info is None:
+            # The size is only known once the image is open
+            img = open_image(file)
+            cost = 1
+            if img is not None:
+                cost = min(img.getStackSize() * get_memory_cost(img.getWidth(), img.getHeight(), bytes_per_pixel),
+                           memory_budget)
+        else:
+            # Multi-page TIFFs have one FileInfo per page, ImageJ stacks a
+            # single one with the number of slices
+            n_planes = len(info) if len(info) > 1 else max(1, info[0].nImages)
+            cost = n_planes * get_memory_cost(info[0].width, info[0].height, bytes_per_pixel)
+            if cost > memory_budget:
+                return Task(stream_file, file, settings, files_done)
+
+        turn.await()
+        memory_permits.acquire(cost)
+    finally:
+        next_turn.countDown()
+
+    if info is not None:
+        try:
+            img = open_image(file, info)
+        except:
+            memory_permits.release(cost)
+            raise
+    return Task(convert_file, file, img, cost, settings, write_pool, memory_permits, files_done)
+
+
+def report_progress(files_done, last_reported, total_files):
+    """Updates the progress bar if more files are done since the last update
+
+    Parameters
+    ----------
+    files_done : AtomicInteger
+        Number of files done
+    last_reported : [int]
+        Number of files done at the last update, updated in place
+    total_files : int
+        Total number of files to convert
+    """
+
+    done = files_done.get()
+    if done != last_reported[0]:
+        last_reported[0] = done
+        progress_bar(done, total_files, 1, "Processing: " + str(done))
 
 
 def get_mean_intensity(image_path):
@@ -217,6 +1071,15 @@ def get_mean_intensity(image_path):
         timed_log("Error: Calibration image is not 32-bit: {}".format(image_path))
     	raise ValueError("Calibration image is not 32-bit: {}".format(image_path))
     	    
+    # For large images without a selection, the mean of every 4th pixel in each
+    # direction is a close enough estimate: 1/16 of the pixels still leaves over
+    # a million samples
+    ip = img.getProcessor()
+    if img.getRoi() is None and ip.getPixelCount() > 16 * 1024 * 1024:
+        ip.setInterpolationMethod(ImageProcessor.NONE)
+        sampled_ip = ip.resize(ip.getWidth() / 4)
+        return ImageStatistics.getStatistics(sampled_ip, Measurements.MEAN, None).mean
+
     stats = img.getStatistics()
     return stats.mean
     
@@ -224,6 +1087,7 @@ def get_mean_intensity(image_path):
 
 IJ.log("\\Clear")
 timed_log("Script starting")
+IJ.log("") # Place for progress bar
 
 
 if calib_mode == "From calibration images":
@@ -232,7 +1096,6 @@ if calib_mode == "From calibration images":
         raise Exception("Both calibration images (lower pH and upper pH) must be selected for image-based calibration.")
     lower_ratio = get_mean_intensity(lower_image.getAbsolutePath())
     upper_ratio = get_mean_intensity(upper_image.getAbsolutePath())
-    IJ.log("") # Place for progress bar
     timed_log("Info: Calibration image (lower pH) -> mean ratio: {:.6f}".format(lower_ratio))
     timed_log("Info: Calibration image (upper pH) -> mean ratio: {:.6f}".format(upper_ratio))
 
@@ -245,54 +1108,115 @@ else:
     timed_log("Invalid calibration mode selected.")
     raise Exception("Invalid calibration mode.")
 
+if output_bit_depth == "16-bit" and pH_max <= pH_min:
+    timed_log("Error: The pH range maximum must be larger than the minimum for 16-bit output.")
+    raise Exception("The pH range maximum must be larger than the minimum for 16-bit output.")
+
 
 input_dir = input_dir.getAbsolutePath()
 output_dir = output_dir.getAbsolutePath()
 
 file_ext_filter = [extension_ratio]
 files = getFileList(input_dir, file_ext_filter)
+
+# Skip files converted by an earlier run, unless they changed since
+if not reprocess_existing:
+    outdated = [file for file in files if not is_up_to_date(file, get_output_path(file, output_dir))]
+    if len(outdated) < len(files):
+        timed_log("Info: Skipped {} image(s) with an up-to-date output".format(len(files) - len(outdated)))
+    files = outdated
 total_files = len(files)
 
 
-for i, file in enumerate(files, 1):
-    # Get basename of file
-    basename = os.path.basename(file) 
-    
-    progress_bar(i, total_files, 1, "Processing: " + str(i))
+# Load the LUT once and share it between all images
+lut = LutLoader.getLut(lut_method)
+if not lut:
+	# Select LUT does not exist. 
+	# Check if Green Fire Blue exists 
+    lut = LutLoader.getLut("Green Fire Blue")
+    if lut:
+        timed_log("LUT '" + lut_method + "' does not exist. Using default: 'Green Fire Blue'")
+        lut_method = "Green Fire Blue"
+    else:
+    	# Green Fire Blue does not exist. 
+    	# Use a built-in LUT
+        timed_log("LUT '" + lut_method + "' does not exist. Using default: 'Fire'")
+        lut_method = "Fire"
+        lut = LutLoader.getLut(lut_method)
 
-    img = IJ.openImage(file)    
-    if img is None:
-        timed_log("Info: Could not open image: {}".format(basename))
-        continue
-    
-    if img.getProcessor().getBitDepth() != 32:
-    	timed_log("Info: Image is not 32-bit: {}".format(basename))
-    	continue
+# Compile the pixel kernel and tabulate the polynomial once for all files
+pH_kernel = load_pH_kernel(B3, B2, B1, B0)
 
-	# Process the image 
-    pH_img = process_image(img, lower_ratio, upper_ratio, B3, B2, B1, B0)
-    
-    # Apply LUT
-    if not LutLoader.getLut(lut_method):
-    	# Select LUT does not exist. 
-    	# Check if Green Fire Blue exists 
-        if LutLoader.getLut("Green Fire Blue"):
-            timed_log("LUT '" + lut_method + "' does not exist. Using default: 'Green Fire Blue'")
-            lut_method = "Green Fire Blue"
-        else:
-        	# Green Fire Blue does not exist. 
-        	# Use a built-in LUT
-            timed_log("LUT '" + lut_method + "' does not exist. Using default: 'Fire'")
-            lut_method = "Fire"
-    IJ.run(pH_img, lut_method, "")
-    
-    # Set Calibration Bar
-    IJ.setMinAndMax(pH_img, pH_min, pH_max)
-    IJ.run(pH_img, "Calibration Bar...", "location=[Upper Right] fill=White label=Black number=5 decimal=3 font=12 zoom=1 overlay")
+# The calibration bar is the same for every image, so draw it only once
+calibration_bar = make_calibration_bar(lut, pH_min, pH_max)
+
+settings = ConversionSettings(lower_ratio, upper_ratio, B3, B2, B1, B0, pH_kernel, pH_min, pH_max,
+                              output_bit_depth, lut, calibration_bar, output_dir)
+
+# Finished images are written by a single thread, so writes don't compete for
+# the disk and overlap with the conversion of the next files
+write_pool = Executors.newSingleThreadExecutor()
+
+# Every image holds permits for its pixels, in megabytes, from the moment it is
+# opened until it is written, so the images in flight never use more than half
+# of the heap however many workers there are. Only images that don't fit into
+# the budget even on their own are streamed in strips, so the output format
+# does not depend on the number of CPUs.
+memory_budget = int(Runtime.getRuntime().maxMemory() / 2 / (1024 * 1024))
+memory_permits = Semaphore(memory_budget, True)
+
+# Files are independent of each other, so convert them in parallel. When all
+# workers are busy and the queue is full, the main thread converts the next
+# file itself, which keeps the number of images held in memory bounded.
+n_threads = Runtime.getRuntime().availableProcessors()
+pool = ThreadPoolExecutor(n_threads, n_threads, 0, TimeUnit.MILLISECONDS,
+                          ArrayBlockingQueue(n_threads), ThreadPoolExecutor.CallerRunsPolicy())
+# Decode the next files while the current ones are converted. A couple of
+# reader threads are enough; more concurrent reads only make the disk seek.
+io_pool = Executors.newFixedThreadPool(2)
+prefetch = 4
+
+# Each IJ.log call appends to the log window, so the progress bar is updated
+# from a single thread at most every 200 ms instead of once per file. A file
+# counts as done once its output is written or it is skipped.
+files_done = AtomicInteger(0)
+last_reported = [0]
+progress_timer = Executors.newSingleThreadScheduledExecutor()
+progress_timer.scheduleAtFixedRate(lambda: report_progress(files_done, last_reported, total_files),
+                                   0, 200, TimeUnit.MILLISECONDS)
+
+try:
+    # Each reader task takes its memory permits after the one before it
+    turn = CountDownLatch(0)
+    opening = deque()
+    futures = []
+    for file in files:
+        next_turn = CountDownLatch(1)
+        opening.append(io_pool.submit(Task(prepare_file, file, turn, next_turn, settings,
+                                           write_pool, memory_permits, memory_budget, files_done)))
+        turn = next_turn
+        if len(opening) == prefetch:
+            futures.append(pool.submit(opening.popleft().get()))
+    while opening:
+        futures.append(pool.submit(opening.popleft().get()))
 
-	# Save image
-    out_path = os.path.join(output_dir, pH_img.getTitle())
-    IJ.saveAs(pH_img, "Tiff", out_path)
+    for future in futures:
+        write = future.get()
+        if write is not None:
+            write.get()
+except:
+    # Don't start the remaining files if one of them failed
+    progress_timer.shutdownNow()
+    io_pool.shutdownNow()
+    pool.shutdownNow()
+    write_pool.shutdownNow()
+    raise
+io_pool.shutdown()
+pool.shutdown()
+write_pool.shutdown()
+progress_timer.shutdown()
+progress_timer.awaitTermination(1, TimeUnit.SECONDS)
+report_progress(files_done, last_reported, total_files)
 
 timed_log("Script finished !")
 print("Script finished !")